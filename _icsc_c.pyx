@@ -0,0 +1,61 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+C implementation of the ICSC packet builder
+
+Build it next to pyICSC.py with:
+    cythonize -i _icsc_c.pyx
+pyICSC uses the pure Python path when this extension is not built.
+"""
+from libc.string cimport memcpy
+
+cdef enum:
+    SOH = 0x01
+    STX = 0x02
+    ETX = 0x03
+    EOT = 0x04
+
+    SOH_IDX = 0
+    DEST_ID_IDX = 1
+    ORIG_ID_IDX = 2
+    CMD_IDX = 3
+    DAT_LEN_IDX = 4
+    STX_IDX = 5
+
+    MIN_MSG_LEN = 9
+    MAX_DAT_LEN = 255
+
+
+def build_packet(unsigned char[::1] packet, unsigned char dest_id, unsigned char orig_id,
+                 unsigned char cmd, const unsigned char[::1] data):
+    """
+    Writes the packet at the start of the packet buffer (at least
+    MIN_MSG_LEN + len(data) bytes long) and returns its length.
+    """
+    cdef Py_ssize_t dat_len = data.shape[0]
+    cdef Py_ssize_t etx_idx = STX_IDX + 1 + dat_len
+    cdef Py_ssize_t i
+    cdef unsigned int check_sum = 0
+
+    if dat_len > MAX_DAT_LEN:
+        raise ValueError("ICSC data is limited to {} bytes".format(MAX_DAT_LEN))
+    if packet.shape[0] < MIN_MSG_LEN + dat_len:
+        raise ValueError("packet buffer is too small")
+
+    packet[SOH_IDX] = SOH
+    packet[DEST_ID_IDX] = dest_id
+    packet[ORIG_ID_IDX] = orig_id
+    packet[CMD_IDX] = cmd
+    packet[DAT_LEN_IDX] = <unsigned char> dat_len
+    packet[STX_IDX] = STX
+    if dat_len > 0:
+        memcpy(&packet[STX_IDX + 1], &data[0], dat_len)
+
+    with nogil:
+        for i in range(DEST_ID_IDX, etx_idx):
+            check_sum += packet[i]
+    check_sum -= STX  # STX is not part of the checksum
+
+    packet[etx_idx] = ETX
+    packet[etx_idx + 1] = <unsigned char> check_sum
+    packet[etx_idx + 2] = EOT
+    return MIN_MSG_LEN + dat_len
@@ -0,0 +1,77 @@
+"""
+Numba compiled ICSC packet validation
+
+Importing this module fails with ImportError when numba is not installed,
+in that case pyICSC validates the packets in pure Python.
+"""
+from numba import njit
+
+SOH = 0x01
+STX = 0x02
+ETX = 0x03
+EOT = 0x04
+
+SOH_IDX = 0
+DEST_ID_IDX = 1
+ORIG_ID_IDX = 2
+CMD_IDX = 3
+DAT_LEN_IDX = 4
+STX_IDX = 5
+
+MIN_MSG_LEN = 9
+ICSC_BROADCAST = 0x00
+
+# Same values as pyICSC.FlowError
+NO_ERROR = 0
+TO_SHORT_MSG = 3
+WRONG_DEST_STATION = 5
+BAD_LEN_FIELD = 6
+BAD_CHECKSUM = 7
+MISSING_SOH = 8
+MISSING_STX = 9
+MISSING_ETX = 10
+MISSING_EOT = 11
+
+
+@njit(cache=True)
+def extract(data, station, allow_bad_checksum):
+    """
+    Validates a raw packet (bytes, bytearray or memoryview).
+    Returns (error, dest_id, orig_id, cmd, dat_len, payload_start, payload_end),
+    only error is meaningful when it is not NO_ERROR.
+    """
+    len_ = len(data)
+    if len_ < MIN_MSG_LEN:
+        return TO_SHORT_MSG, 0, 0, 0, 0, 0, 0
+
+    dat_len = data[DAT_LEN_IDX]
+    if len_ != MIN_MSG_LEN + dat_len:
+        return BAD_LEN_FIELD, 0, 0, 0, 0, 0, 0
+
+    dest_id = data[DEST_ID_IDX]
+    if dest_id != station and dest_id != ICSC_BROADCAST:
+        return WRONG_DEST_STATION, 0, 0, 0, 0, 0, 0
+
+    etx_idx = STX_IDX + 1 + dat_len
+    # The four control bytes are checked with a single branch, the
+    # individual comparisons only run to name the missing one
+    if ((data[SOH_IDX] ^ SOH) | (data[STX_IDX] ^ STX) |
+            (data[etx_idx] ^ ETX) | (data[etx_idx + 2] ^ EOT)) != 0:
+        if data[SOH_IDX] != SOH:
+            return MISSING_SOH, 0, 0, 0, 0, 0, 0
+        if data[STX_IDX] != STX:
+            return MISSING_STX, 0, 0, 0, 0, 0, 0
+        if data[etx_idx] != ETX:
+            return MISSING_ETX, 0, 0, 0, 0, 0, 0
+        return MISSING_EOT, 0, 0, 0, 0, 0, 0
+
+    if not allow_bad_checksum:
+        check_sum = 0
+        for i in range(DEST_ID_IDX, etx_idx):
+            check_sum += data[i]
+        # STX is not part of the checksum
+        if (check_sum - STX) & 0xFF != data[etx_idx + 1]:
+            return BAD_CHECKSUM, 0, 0, 0, 0, 0, 0
+
+    return (NO_ERROR, dest_id, data[ORIG_ID_IDX], data[CMD_IDX], dat_len,
+            STX_IDX + 1, etx_idx)
@@ -5,12 +5,38 @@ ICSC protocol implementation
 inspired on the python example of Majenko ICSC repo:
 https://github.com/MajenkoLibraries/ICSC/tree/master/other/python
 """
+from collections import namedtuple
 from enum import IntEnum
-import timeout_decorator
+from functools import lru_cache
+import logging
 
 import serial
-import array
-from curses.ascii import *
+
+try:
+    # optional C packet builder, see _icsc_c.pyx
+    from _icsc_c import build_packet
+except ImportError:
+    build_packet = None
+
+try:
+    # optional numba compiled packet validation, see _icsc_numba.py
+    from _icsc_numba import extract as jit_extract
+except ImportError:
+    jit_extract = None
+
+_log = logging.getLogger(__name__)
+
+# ASCII control characters used by the protocol
+NUL = 0x00
+SOH = 0x01
+STX = 0x02
+ETX = 0x03
+EOT = 0x04
+ENQ = 0x05
+ACK = 0x06
+BEL = 0x07
+BS = 0x08
+HT = 0x09
 
 SOH_IDX = 0
 DEST_ID_IDX = 1
@@ -28,6 +54,25 @@ ICSC_BROADCAST = NUL  # 0x00
 ICSC_SYS_RELAY = HT  # 0x09
 
 MIN_MSG_LEN = 9
+MAX_DAT_LEN = 255
+
+# Buffers at least this long are summed with numpy (when it is installed).
+# Below it the cost of wrapping the buffer outweighs the vectorized sum.
+NUMPY_CHECKSUM_MIN_LEN = 192
+
+# Size of the buffer that holds the bytes read from the serial port
+RX_BUFFER_SIZE = 8192
+
+
+@lru_cache(maxsize=None)
+def _numpy():
+    # numpy is optional and slow to import, so it is only loaded the first
+    # time a long buffer has to be summed
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
 
 
 class FlowError(IntEnum):
@@ -56,6 +101,10 @@ class FlowError(IntEnum):
     MANY_RETRIES = 13
 
 
+# A received message. dest_id, orig_id and cmd are the raw byte values
+Msg = namedtuple('Msg', 'dest_id orig_id cmd dat_len data')
+
+
 class ICSC:
     class Config:
         # Indicates that you want to accept messages with wrong checksum
@@ -67,7 +116,8 @@ class ICSC:
         # maximum time between messages
         PROCESS_TIMEOUT = 1
 
-        # If is true then print some debug text
+        # If is true then the sent and received packets are logged, at DEBUG
+        # level, to the 'pyICSC' logger
         DEBUG = True
 
         # function that is executed when a timeout occurs.
@@ -81,147 +131,264 @@ class ICSC:
         # Indicate the max fail count when receive a msg
         MAX_RECEIVE_FAIL = 1
 
-    def __init__(self, port, baud, station, config=Config):
+        # If true, set the ASYNC_LOW_LATENCY flag of the serial driver (Linux
+        # only). USB serial adapters then deliver the received bytes right
+        # away instead of waiting for their latency timer (up to 16 ms)
+        LOW_LATENCY = False
+
+    def __init__(self, port, baud, station, config=Config, fixed_datlen=None):
         self.config = config
         self.commands_functions = {}
+        # handlers indexed by the command byte, used for dispatching
+        self._cmd_table = [None] * 256
+        # serial input is read in chunks into _rb, messages are sliced out
+        # of the pending bytes between _rb_head and _rb_tail
+        self._rb = bytearray(RX_BUFFER_SIZE)
+        self._rb_view = memoryview(self._rb)
+        self._rb_head = 0
+        self._rb_tail = 0
         self.port = serial.Serial(port=port, baudrate=baud,
                                   timeout=config.PROCESS_TIMEOUT,
                                   parity='N', stopbits=1, bytesize=8)
         self.station = ord(station) if isinstance(station, str) else station
+        # Send packets are assembled in place over this template, only
+        # DEST_ID, CMD, DATLEN, the data and the trailer change per packet
+        self._tx = bytearray(MIN_MSG_LEN + MAX_DAT_LEN)
+        self._tx[:STX_IDX + 1] = bytes([SOH, 0, self.station, 0, 0, STX])
+        self._tx_view = memoryview(self._tx)
+        # If the application always receives fixed_datlen bytes of data, the
+        # packets of that size are decoded by code generated for it
+        self._decode_fixed = None
+        if fixed_datlen is not None:
+            self._decode_fixed = self.__build_fixed_decoder(fixed_datlen)
         self.__init_port()
-        self.commands_functions[ICSC_SYS_PING] = self.__respond_to_ping
+        self.add_command(ICSC_SYS_PING, self.__respond_to_ping)
 
     def __init_port(self):
         if self.port.is_open:
             self.port.close()
         self.port.open()
+        # set_low_latency_mode only exists in the Linux implementation
+        if self.config.LOW_LATENCY and hasattr(self.port, 'set_low_latency_mode'):
+            self.port.set_low_latency_mode(True)
+
+    def __build_fixed_decoder(self, dat_len: int):
+        # Generates a decoder with every index and the checksum unrolled for
+        # packets with dat_len bytes of data. It returns a Msg if the packet
+        # is valid and None otherwise, extract_fields then names the error.
+        if not 0 <= dat_len <= MAX_DAT_LEN:
+            raise ValueError("fixed_datlen must be between 0 and {}".format(MAX_DAT_LEN))
+        etx_idx = STX_IDX + 1 + dat_len
+        checks = [
+            "len(data) == {}".format(MIN_MSG_LEN + dat_len),
+            "data[{}] == {}".format(DAT_LEN_IDX, dat_len),
+            "(data[{0}] == {1} or data[{0}] == {2})".format(DEST_ID_IDX, self.station,
+                                                           ICSC_BROADCAST),
+            "data[{}] == {}".format(SOH_IDX, SOH),
+            "data[{}] == {}".format(STX_IDX, STX),
+            "data[{}] == {}".format(etx_idx, ETX),
+            "data[{}] == {}".format(etx_idx + 2, EOT),
+        ]
+        if not self.config.ALLOW_DATA_WITH_BAD_CHECKSUM:
+            terms = ["data[{}]".format(i) for i in range(DEST_ID_IDX, DAT_LEN_IDX)]
+            terms.append(str(dat_len))
+            terms += ["data[{}]".format(i) for i in range(STX_IDX + 1, etx_idx)]
+            checks.append("({}) & 0xFF == data[{}]".format(" + ".join(terms), etx_idx + 1))
+        source = (
+            "def decode(data):\n"
+            "    if {checks}:\n"
+            "        return Msg(data[{dest}], data[{orig}], data[{cmd}], {dat_len}, "
+            "data[{start}:{end}])\n"
+            "    return None\n"
+        ).format(checks=" and ".join(checks), dest=DEST_ID_IDX, orig=ORIG_ID_IDX,
+                 cmd=CMD_IDX, dat_len=dat_len, start=STX_IDX + 1, end=etx_idx)
+        namespace = {'Msg': Msg}
+        exec(compile(source, '<icsc fixed decoder>', 'exec'), namespace)
+        return namespace['decode']
 
     def __standardize_params(self, destination, command, data):
-        def str_to_bytes(data_):
-            aux = data_
-            data_ = array.array('B')
-            data_.frombytes(aux.encode())
-            return data_
-
         if isinstance(destination, str):
             destination = ord(destination)
         if isinstance(command, str):
             command = ord(command)
         if isinstance(data, str):
-            data = str_to_bytes(data)
+            data = data.encode()
         elif isinstance(data, (int, float)):
             if self.config.SEND_NUMBER_AS_STR:
-                data = str_to_bytes(str(data))
+                data = str(data).encode()
             else:
-                data = array.array('B', [data])
+                data = bytes([data])
+        elif isinstance(data, (list, tuple)):
+            data = bytes(data)
         return destination, command, data
 
     @staticmethod
-    def calculate_checksum(header, data):
-        return (sum(header) + sum(data)) % 256
+    def calculate_checksum(buf) -> int:
+        if len(buf) >= NUMPY_CHECKSUM_MIN_LEN:
+            np = _numpy()
+            if np is not None:
+                return int(np.frombuffer(buf, np.uint8).sum(dtype=np.uint64)) & 0xFF
+        # Without numpy the builtin sum is the fastest option: it is a single
+        # C loop. Splitting it into interleaved accumulators only pays off in
+        # compiled code; written in Python it is several times slower.
+        return sum(buf) & 0xFF
+
+    @staticmethod
+    def __packet_checksum(packet, dat_len: int) -> int:
+        # The header and the payload are summed through a single view of the
+        # packet. STX sits between them and is not part of the checksum.
+        view = memoryview(packet)[DEST_ID_IDX:STX_IDX + 1 + dat_len]
+        return (ICSC.calculate_checksum(view) - STX) & 0xFF
 
     def __respond_to_ping(self, msg):
-        self.send(msg['orig_id'], ICSC_SYS_PONG, [])
+        self.send(msg.orig_id, ICSC_SYS_PONG, [])
 
     def broadcast(self, command, data):
         self.send(ICSC_BROADCAST, command, data)
 
     def send(self, dest_id: object, cmd: object, data: object) -> None:
         dest_id, cmd, data = self.__standardize_params(dest_id, cmd, data)
-        sendpacket = array.array('B',
-                                 [
-                                     SOH,
-                                     dest_id,  # ID
-                                     self.station,  # ORIG_ID
-                                     cmd,  # CMD
-                                     len(data),  # DATLEN
-                                     STX
-                                 ])
-        sendpacket.extend(array.array('B', data))
-        sendpacket.append(ETX)
-        check_sum = self.calculate_checksum([dest_id, self.station, cmd, len(data)], data)
-        sendpacket.append(check_sum)
-        sendpacket.append(EOT)
-        if self.config.DEBUG:
-            print("SEND: {}".format(sendpacket.tobytes()))
-        self.port.write(sendpacket.tobytes())
+        if build_packet is not None:
+            sendpacket = self._tx_view[:build_packet(self._tx, dest_id, self.station, cmd, data)]
+        else:
+            sendpacket = self.__build_packet(dest_id, cmd, data)
+        if self.config.DEBUG and _log.isEnabledFor(logging.DEBUG):
+            _log.debug("SEND: %s", bytes(sendpacket))
+        self.port.write(sendpacket)
+
+    def __build_packet(self, dest_id: int, cmd: int, data) -> memoryview:
+        # The returned view is only valid until the next call
+        dat_len = len(data)
+        etx_idx = STX_IDX + 1 + dat_len
+        tx = self._tx
+        tx[DEST_ID_IDX] = dest_id
+        tx[CMD_IDX] = cmd
+        tx[DAT_LEN_IDX] = dat_len
+        tx[STX_IDX + 1:etx_idx] = data
+        tx[etx_idx] = ETX
+        # same as __packet_checksum, but the header fields are already at hand
+        tx[etx_idx + 1] = (dest_id + self.station + cmd + dat_len +
+                           self.calculate_checksum(data)) & 0xFF
+        tx[etx_idx + 2] = EOT
+        return self._tx_view[:etx_idx + 3]
 
     def add_command(self, cmd: chr, f):
-        if isinstance(cmd, int):
-            cmd = chr(cmd)
+        if isinstance(cmd, str):
+            cmd = ord(cmd)
         self.commands_functions[cmd] = f
+        self._cmd_table[cmd] = f
 
     @staticmethod
-    def validate_fields(data, etx_idx: int, eot_idx: int) -> FlowError:
-        if data[SOH_IDX] != SOH:
+    def validate_fields(data, etx_idx: int, eot_idx: int,
+                        _SOH=SOH, _STX=STX, _ETX=ETX, _EOT=EOT) -> FlowError:
+        # the control bytes are bound as defaults to be read as locals
+        if data[SOH_IDX] != _SOH:
             return FlowError.MISSING_SOH
-        if data[STX_IDX] != STX:
+        if data[STX_IDX] != _STX:
             return FlowError.MISSING_STX
-        if data[etx_idx] != ETX:
+        if data[etx_idx] != _ETX:
             return FlowError.MISSING_ETX
-        if data[eot_idx] != EOT:
+        if data[eot_idx] != _EOT:
             return FlowError.MISSING_EOT
         return FlowError.NO_ERROR
 
-    def extract_fields(self, data) -> (FlowError, dict):
+    # The module constants used per packet are bound as default arguments in
+    # extract_fields and process, so that they are read as locals
+    def extract_fields(self, data, _MIN=MIN_MSG_LEN, _BROADCAST=ICSC_BROADCAST, _FE=FlowError,
+                       _DEST=DEST_ID_IDX, _ORIG=ORIG_ID_IDX, _CMD=CMD_IDX, _DL=DAT_LEN_IDX,
+                       _STI=STX_IDX, _Msg=Msg) -> (FlowError, Msg):
+        if self._decode_fixed is not None:
+            msg = self._decode_fixed(data)
+            if msg is not None:
+                return _FE.NO_ERROR, msg
+
+        if jit_extract is not None:
+            return self.__jit_extract_fields(data)
+
         len_ = len(data)
 
-        if len_ < MIN_MSG_LEN:
-            return FlowError.TO_SHORT_MSG, {}
+        if len_ < _MIN:
+            return _FE.TO_SHORT_MSG, None
 
-        if len_ != MIN_MSG_LEN + data[DAT_LEN_IDX]:
-            return FlowError.BAD_LEN_FIELD, {}
+        dat_len = data[_DL]
+        if len_ != _MIN + dat_len:
+            return _FE.BAD_LEN_FIELD, None
 
-        if data[DEST_ID_IDX] != self.station and data[DEST_ID_IDX] != ICSC_BROADCAST:
-            return FlowError.WRONG_DEST_STATION, {}
+        if data[_DEST] != self.station and data[_DEST] != _BROADCAST:
+            return _FE.WRONG_DEST_STATION, None
 
-        etx_idx = int(data[DAT_LEN_IDX]) + STX_IDX + 1
+        etx_idx = dat_len + _STI + 1
         eot_idx = etx_idx + 2
 
         field_error = self.validate_fields(data, etx_idx, eot_idx)
-        if field_error != FlowError.NO_ERROR:
-            return field_error, {}
+        if field_error != _FE.NO_ERROR:
+            return field_error, None
 
-        payload = data[STX_IDX + 1:-3]  # STX -> ETX
         if not self.config.ALLOW_DATA_WITH_BAD_CHECKSUM:
             checksum_idx = len_ - 2
-            header = [data[DEST_ID_IDX], data[ORIG_ID_IDX], data[CMD_IDX], data[DAT_LEN_IDX]]
-            if not self.calculate_checksum(header, payload) == data[checksum_idx]:
-                return FlowError.BAD_CHECKSUM, {}
-
-        return (FlowError.NO_ERROR, {
-            "dest_id": chr(data[DEST_ID_IDX]),
-            "orig_id": chr(data[ORIG_ID_IDX]),
-            "cmd": chr(data[CMD_IDX]),
-            "dat_len": data[DAT_LEN_IDX],
-            "data": payload
-        })
-
-    def read_from_serial(self) -> bytearray:
-        in_data = b''
-        try:
-            in_data = self.port.read_until(bytearray([EOT]))
-        except timeout_decorator.timeout_decorator.TimeoutError:
+            if not self.__packet_checksum(data, dat_len) == data[checksum_idx]:
+                return _FE.BAD_CHECKSUM, None
+
+        # The payload is copied only once the packet is known to be valid.
+        # A memoryview is not used: for payloads up to MAX_DAT_LEN creating
+        # it costs more than the copy and it lacks the bytes API.
+        payload = data[_STI + 1:etx_idx]  # STX -> ETX
+        return _FE.NO_ERROR, _Msg(data[_DEST], data[_ORIG], data[_CMD], dat_len, payload)
+
+    def __jit_extract_fields(self, data) -> (FlowError, Msg):
+        error, dest_id, orig_id, cmd, dat_len, payload_start, payload_end = jit_extract(
+            data, self.station, self.config.ALLOW_DATA_WITH_BAD_CHECKSUM)
+        if error != FlowError.NO_ERROR:
+            return FlowError(error), None
+        return FlowError.NO_ERROR, Msg(dest_id, orig_id, cmd, dat_len,
+                                       data[payload_start:payload_end])
+
+    def __fill_rx_buffer(self, count: int) -> bool:
+        # Makes sure that at least count bytes are pending in the receive
+        # buffer. Returns False if the port timed out before.
+        head, tail = self._rb_head, self._rb_tail
+        if tail - head >= count:
+            return True
+        if head == tail:
+            head = tail = 0
+        elif RX_BUFFER_SIZE - head < count:
+            # move the pending bytes to the front to make room
+            self._rb[:tail - head] = self._rb[head:tail]
+            head, tail = 0, tail - head
+        self._rb_head = head
+        # Read the missing bytes, plus anything else already waiting, in a
+        # single call. The port returns as soon as that count is reached.
+        size = min(RX_BUFFER_SIZE - tail, max(count - (tail - head), self.port.in_waiting))
+        self._rb_tail = tail + self.port.readinto(self._rb_view[tail:tail + size])
+        return self._rb_tail - head >= count
+
+    def read_from_serial(self) -> bytes:
+        # The message length is known from its DATLEN field, so exactly that
+        # many bytes are read instead of scanning for EOT (which can also
+        # appear in the data or the checksum)
+        end = None
+        if self.__fill_rx_buffer(1):
+            head = self._rb_head
+            if self._rb[head] != SOH:
+                # Not a message start: hand back everything up to the
+                # next SOH so that the error gets reported
+                end = self._rb.find(SOH, head + 1, self._rb_tail)
+                if end < 0:
+                    end = self._rb_tail
+            elif self.__fill_rx_buffer(DAT_LEN_IDX + 1):
+                msg_len = MIN_MSG_LEN + self._rb[self._rb_head + DAT_LEN_IDX]
+                if self.__fill_rx_buffer(msg_len):
+                    end = self._rb_head + msg_len
+        if end is None:
+            # the port timed out, the pending bytes are returned
+            end = self._rb_tail
             if self.config.ON_TIMEOUT_CALLBACK is not None:
                 self.config.ON_TIMEOUT_CALLBACK()
+        in_data = bytes(self._rb_view[self._rb_head:end])
+        self._rb_head = end
         return in_data
 
-    @staticmethod
-    def is_truncated_msg(in_data: bytearray, error: FlowError) -> bool:
-        return in_data.endswith(bytearray([EOT])) and \
-               error in [FlowError.BAD_LEN_FIELD, FlowError.TO_SHORT_MSG]
-
-    def get_msg(self, in_data: bytearray) -> (FlowError, dict):
-        error, msg = self.extract_fields(in_data)
-        while self.is_truncated_msg(in_data, error):
-            remaining = self.read_from_serial()
-            in_data += remaining  # == in_data + remaining
-            error, msg = self.extract_fields(in_data)
-            if error == FlowError.NO_ERROR or len(remaining) == 0:
-                break
-        return error, msg
-
-    def process(self) -> (FlowError, dict):
+    def process(self, _FE=FlowError) -> (FlowError, Msg):
         fail_count = 0
         while True:
             in_data = self.read_from_serial()
@@ -229,16 +396,17 @@ class ICSC:
                 fail_count = 0
                 if self.config.ON_MAX_FAILED_CALLBACK is not None:
                     self.config.ON_MAX_FAILED_CALLBACK()
-                return FlowError.TIMEOUT, {}
+                return _FE.TIMEOUT, None
             if len(in_data) == 0:
                 fail_count += 1
                 continue
-            error, msg = self.get_msg(in_data)
-            if error != FlowError.NO_ERROR:
-                return error, {}
+            error, msg = self.extract_fields(in_data)
+            if error != _FE.NO_ERROR:
+                return error, None
             if self.config.DEBUG:
-                print("IN DATA: {}".format(in_data))
-                print("IN MSG: {}".format(in_data))
-            if 'cmd' in msg and msg['cmd'] in self.commands_functions:
-                self.commands_functions[msg['cmd']](msg)
-            return FlowError.NO_ERROR, msg
+                _log.debug("IN DATA: %s", in_data)
+                _log.debug("IN MSG: %s", msg)
+            f = self._cmd_table[msg.cmd]
+            if f is not None:
+                f(msg)
+            return _FE.NO_ERROR, msg